@@ -91,8 +91,14 @@ class OpenPMDreader(Dumpreader_ifc):
             # constant data (a single int or float)
             ret = np.float64(record.attrs['value']) * record.attrs['unitSI']
         else:
-            # array data
-            ret = np.float64(record[()]) * record.attrs['unitSI']
+            # array data. Read directly into a float64 array and scale in place
+            # to avoid the temporaries of the dtype conversion and the multiplication.
+            ret = np.empty(record.shape, dtype=np.float64)
+            record.read_direct(ret)
+            ret *= record.attrs['unitSI']
+            if ret.ndim == 0:
+                # scalar dataset: return a np.float64, not a 0-d array
+                ret = ret[()]
         return ret
 
     def gridoffset(self, key, axis):
@@ -255,14 +261,13 @@ class FbpicReader(OpenPMDreader):
         converts to radial data using `modeexpansion`, possibly for multiple
         theta at once.
         '''
-        if np.asarray(theta).shape == ():
-            # single theta
-            theta = [theta]
-        # multiple theta
-        data = np.asarray([FbpicReader._modeexpansion_naiv_single(rawdata, theta=t)
-                           for t in theta])
-        # switch from (theta, r, z) to (r, theta, z)
-        data = data.swapaxes(0, 1)
+        # single or multiple theta
+        theta = np.atleast_1d(np.asarray(theta, dtype=np.float64))
+        (Nm, Nr, Nz) = np.shape(rawdata)
+        # write every theta directly into its slot of the (r, theta, z) result
+        data = np.empty((Nr, len(theta), Nz))
+        for i, t in enumerate(theta):
+            data[:, i, :] = FbpicReader._modeexpansion_naiv_single(rawdata, theta=t)
         return data
 
     @staticmethod
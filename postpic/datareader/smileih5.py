@@ -27,13 +27,75 @@ import os.path
 import h5py
 import glob
 import numpy as np
-from .. import helper
 from ..helper_fft import fft
-import re
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 __all__ = ['SmileiReader', 'SmileiSeries']
 
 
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _modeexp_kernel(real, imag, cos_mt, sin_mt, out):
+        '''
+        Adds the mode expansion of the modes given by `real` and `imag`
+        (each of shape (Nm, Nx, Nr)) to `out` of shape (Ntheta, Nx, Nr).
+        Every element of the raw data is read only once per theta.
+        '''
+        (Nm, Nx, Nr) = real.shape
+        Nt = out.shape[0]
+        # parallelize over x, as there is often only a single theta.
+        for x in numba.prange(Nx):
+            for t in range(Nt):
+                for m in range(Nm):
+                    c = cos_mt[m, t]
+                    s = sin_mt[m, t]
+                    for r in range(Nr):
+                        out[t, x, r] += real[m, x, r] * c + imag[m, x, r] * s
+else:
+    # numba is not available. `np.einsum` will be used instead.
+    _modeexp_kernel = None
+
+
+def _listh5objects(fname):
+    '''
+    Returns a list of `(key, attrs)` for all objects in the h5 file fname, which
+    need to be present in the index file. attrs is None for objects, which will be
+    externally linked and a dict containing the attributes for groups.
+
+    The h5 file is opened read-only. `_generateh5indexfile` writes the index
+    file from the returned list.
+    '''
+    ret = []
+
+    def visitf(name, info):
+        # name is a bytes object, info the h5py.h5o.ObjInfo of the object
+        key = name.decode('utf-8')
+        if key == '.' or key.endswith('latest_IDs'):
+            return
+        # only link if key points to a dataset. Generally do not link groups.
+        # However single scalars (identified by ´value in hf[key].attrs´)
+        # maybe a group and must be linked as well.
+        # The object type is known from info, so the high level object is only
+        # created for groups to read their attributes.
+        if info.type == h5py.h5o.TYPE_DATASET:
+            ret.append((key, None))
+        elif info.type == h5py.h5o.TYPE_GROUP:
+            attrs = hf[key].attrs
+            if "value" in attrs:
+                ret.append((key, None))
+            else:
+                ret.append((key, dict(attrs)))
+
+    with h5py.File(fname, 'r') as hf:
+        # low level visit, which passes the object info along with the name.
+        h5py.h5o.visit(hf.id, visitf, info=True)
+    return ret
+
+
 def _generateh5indexfile(indexfile, fnames):
     '''
     Creates a h5 index file called indexfile containing external links to all h5
@@ -41,30 +103,25 @@ def _generateh5indexfile(indexfile, fnames):
     will only be externally linked within the new indexfile.
     Therefore the indexfile will also be small in size.
 
+    The h5 files are traversed serially on purpose. A process pool would hang at
+    interpreter exit after the numba kernel started its thread pool (`fork`) and
+    would re-run unguarded user scripts in its workers (`spawn`, `forkserver`).
+
     Will throw an error, if any of the h5 files contain a dataset under the same name.
     '''
     if os.path.isfile(indexfile):
         # indexfile already exists. do not recreate
         return
 
-    def visitf(key):
-        # key is a string
-        if key.endswith('latest_IDs'):
-            return
-        # only link if key points to a dataset. Generally do not link groups.
-        # However single scalars (identified by ´value in hf[key].attrs´)
-        # maybe a group and must be linked as well.
-        if isinstance(hf[key], h5py._hl.dataset.Dataset) or "value" in hf[key].attrs:
-            ih[key] = h5py.ExternalLink(fname, key)
-        elif isinstance(hf[key], h5py._hl.group.Group) and key not in ih:
-            ih.create_group(key)
-            for attr in hf[key].attrs:
-                ih[key].attrs[attr] = hf[key].attrs[attr]
-
     with h5py.File(indexfile, 'w') as ih:
         for fname in fnames:
-            with h5py.File(fname, 'r') as hf:
-                hf.visit(visitf)
+            for key, attrs in _listh5objects(fname):
+                if attrs is None:
+                    ih[key] = h5py.ExternalLink(fname, key)
+                elif key not in ih:
+                    ih.create_group(key)
+                    for attr in attrs:
+                        ih[key].attrs[attr] = attrs[attr]
 
 
 def _getindexfile(path):
@@ -96,6 +153,11 @@ class SmileiReader(OpenPMDreader):
     `.postpic-smilei-index.h5` which contains external links to all
     datasets in this directory.
 
+    If numba can be imported, the mode expansion of AM mode fields uses a
+    parallel numba kernel. Its first call starts numba's thread pool within
+    the current process, which makes a later `fork` of this process
+    (e.g. by a `multiprocessing` pool using the fork start method) unsafe.
+
     Args:
       h5file : String
         A String containing the relative Path to the h5 files of the simulation
@@ -105,126 +167,193 @@ class SmileiReader(OpenPMDreader):
       iteration : Integer
         An integer indicating the iteration to be loaded. Default is None, leading
         to the first iteration found in the h5file to be loaded.
+
+    Kwargs:
+      rdcc_nbytes : Integer
+        Size of the hdf5 chunk cache in bytes. Default is 64 MiB. AM mode datasets
+        are usually accessed multiple times and their chunks often exceed the
+        h5py default of 1 MiB, which would lead to the same chunks being read
+        over and over again.
+
+      rdcc_nslots : Integer
+        Number of chunk slots in the hdf5 chunk cache. Should be a prime number.
+        Default is 6151.
+
+      h5 : h5py.File
+        An already opened h5py.File of `h5file` (or of its index file) to be used
+        instead of opening the file again. Used by `SmileiSeries` to share a single
+        file handle among all readers. Subclasses overriding `__init__` must pass
+        this kwarg on to `SmileiReader.__init__`.
     '''
 
-    def __init__(self, h5file, iteration=None):
+    def __init__(self, h5file, iteration=None, rdcc_nbytes=64 * 1024**2, rdcc_nslots=6151,
+                 h5=None):
         # The class given to super is the OpenPMDreader class, not the SmileiReader class.
         # This is on purpose to NOT run the `OpenPMDreader.__init__`.
         super(OpenPMDreader, self).__init__(h5file)
+        h5kwargs = dict(rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots, rdcc_w0=0.75)
         # Smilei uses multiple h5 files and also the iteration encoding differs from openPMD.
-        if os.path.isfile(h5file):
-            self._h5 = h5py.File(h5file, 'r')
+        if h5 is not None:
+            self._h5 = h5
+        elif os.path.isfile(h5file):
+            self._h5 = h5py.File(h5file, 'r', **h5kwargs)
         elif os.path.isdir(h5file):
+            # the chunk cache settings are inherited by the externally linked files.
             indexfile = _getindexfile(h5file)
-            self._h5 = h5py.File(indexfile, 'r')
+            self._h5 = h5py.File(indexfile, 'r', **h5kwargs)
         else:
             raise IOError('"{}" is neither a h5 file nor a directory'
                           'containing h5 files'.format(h5file))
+        self._openiteration(iteration)
 
+    def _openiteration(self, iteration):
+        '''
+        Selects the dump of the given iteration within `self._h5`.
+        '''
+        # the dumps are stored as `data/{:010d}`. Look up the requested iteration
+        # directly instead of listing and parsing all dumps in the file.
+        dumps = self._h5['data']
         if iteration is None:
-            self._iteration = int(list(self._h5['data'].keys())[0])
-        elif iteration not in [int(i) for i in list(self._h5['data'].keys())]:
+            self._iteration = int(next(iter(dumps)))
+            iteration = self._iteration
+        try:
+            valid = int(iteration) == iteration
+        except (TypeError, ValueError):
+            valid = False
+        # the iteration must be integral. Do not truncate e.g. 100.9 to 100.
+        if not valid or '{:010d}'.format(int(iteration)) not in dumps:
             raise IOError("Iteration {} is in valid".format(iteration))
-        else:
-            self._iteration = int(iteration)
+        self._iteration = int(iteration)
 
         self._data = self._h5['/data/{:010d}/'.format(self._iteration)]
         self.attrs = self._data.attrs
+        # the AM modes of a dump do not change. Cache them, see `_listAMmodes`.
+        self._ammodes = None
+        # dataset name -> shape. The file is read-only, see `_shape`.
+        self._shapes = {}
 
     @staticmethod
-    def _modeexpansion_naiv(rawdata, theta=0):
+    def _modeexpansion_naiv(real, imag, theta=0, unitSI=None, modes=None):
         '''
-        This method performes mode expansion of the raw data (an array consisting of complex
-        numbers) for both single and multiple theta vaues.
+        This method performes mode expansion of the raw data (given as separate arrays
+        for the real and imaginary parts of the modes) for both single and multiple
+        theta vaues.
 
         The output array has the shape (No.of theta, Nx, Nr)
 
         Args:
-            rawdata : numpy array
-            The elements of this array are complex numbers, this got structured from the
-            raw data dumped in h5 file through getExpanded(key, theta) function.
+            real : numpy array
+            The real parts of the modes with shape (Nm, Nx, Nr).
+
+            imag : numpy array
+            The imaginary parts of the modes with shape (Nm, Nx, Nr).
+            Both arrays are usually views into the raw data dumped in the h5 file,
+            see _getExpanded(key, theta) function.
 
             theta : float/integer OR list of floats/integer
 
+            unitSI : None OR numpy array
+            The factor of every mode to convert to SI units with shape (Nm,).
+            It is applied to the (Nm, Ntheta) table of cos and sin coefficients,
+            so the raw data itself is never scaled.
+
+            modes : None OR list of integers
+            The mode numbers of the Nm modes. Default is None, meaning 0, 1, ..., Nm-1.
+
         Output F_total is an array of real numbers which has shape (Np.of theta, Nx, Nr),
         this F_total is the real value summation of the fourier series.
         '''
-        if np.array(theta).shape == ():
-            theta = [theta]
-
-        array_list = []
-
-        (Nm, Nx, Nr) = rawdata.shape
-        F_total = np.zeros((Nx, Nr))
-        mode = [m for m in range(0, Nm)]
-        for t in theta:
-
-            for m in mode:
-                F_total += np.real(rawdata[m])*np.cos(m*t)+np.imag(rawdata[m])*np.sin(m*t)
-            array_list.append(F_total)
-
-        mod_F_total = np.stack(array_list, axis=0)
-        return mod_F_total
+        theta = np.atleast_1d(np.asarray(theta, dtype=np.float64))
+        (Nm, Nx, Nr) = real.shape
+        m = np.arange(Nm) if modes is None else np.asarray(modes)
+        # shape (Nm, Ntheta)
+        cos_mt = np.cos(np.outer(m, theta))
+        sin_mt = np.sin(np.outer(m, theta))
+        if unitSI is not None:
+            unitSI = np.asarray(unitSI, dtype=np.float64)[:, np.newaxis]
+            cos_mt *= unitSI
+            sin_mt *= unitSI
+        if _modeexp_kernel is not None:
+            F_total = np.zeros((len(theta), Nx, Nr))
+            _modeexp_kernel(real, imag, cos_mt, sin_mt, F_total)
+        else:
+            F_total = np.einsum('mt,mxr->txr', cos_mt, real)
+            F_total += np.einsum('mt,mxr->txr', sin_mt, imag)
+        return F_total
 
 # --- Level 0 methods ---
 
     def _listAMmodes(self):
         '''
-        This method is used to get the list of
-        [prefix of field names, No.of AM modes] available in the dump.
+        This method is used to get a dict mapping the prefixes of the field names
+        dumped in AM modes to their sorted mode numbers, e.g. {'El': [0, 1], 'Er': [0, 1]}.
         And it works only for AM mode technique.
+
+        The result is computed on the first call only and cached afterwards.
         '''
-        strings = np.array(self._data)
-        mask = np.array(["_mode_" in s for s in strings])
-        arr = strings[mask]
-        if len(arr) == 0:
-            return ([], [])
-        max_suffix = float('-inf')
-        max_suffix_string = None
-        prefix_list = []
-
-        for i in arr:
-            prefix, suffix = i.split('_mode_')
-            suffix_int = int(suffix)
-            if suffix_int > max_suffix:
-                max_suffix = suffix_int
-                max_suffix_string = i
-            prefix_list.append(prefix)
-
-        availModes = [i for i in range(0, int(max_suffix_string[-1])+1)]
-
-        # [field names prefix, available AM modes]
-        return [prefix_list, availModes]
+        if self._ammodes is not None:
+            return self._ammodes
+        prefix_to_modes = {}
+
+        # a single pass over the names in the group, without creating a list first
+        for name in self._data.keys():
+            prefix, sep, suffix = name.rpartition('_mode_')
+            if not sep:
+                continue
+            prefix_to_modes.setdefault(prefix, []).append(int(suffix))
+
+        for modes in prefix_to_modes.values():
+            modes.sort()
+        self._ammodes = prefix_to_modes
+        return self._ammodes
+
+    def _shape(self, name):
+        '''
+        Returns the shape of the dataset `name`. The shapes are cached, as the
+        grid methods query them repeatedly and every query is a hdf5 metadata lookup.
+        '''
+        if name not in self._shapes:
+            self._shapes[name] = self._data[name].shape
+        return self._shapes[name]
+
+    def _isAMkey(self, key):
+        '''
+        True, if the field `key` is dumped in AM modes, e.g. `El` for the datasets
+        `El_mode_0`, `El_mode_1`, ... A dict lookup, no scan over the dataset names.
+        '''
+        return key in self._listAMmodes()
 
 # --- Level 1 methods ---
 
     def _getExpanded(self, key, theta=0):
         '''
-        _getExpanded() method converts the raw data real number array from h5file into
-        a complex number array (This convertion is important while performing mode expansion)
-        and finally returns the mode expanded array.
+        _getExpanded() method reads the raw data real number array of all modes from h5file
+        and returns the mode expanded array.
 
         This method takes input from the h5files dump which has the following format,
         field array = [[real_1,imag_1,real_2,image_2,.....],...]
         The shape of this field array is (Nx, 2x Nr)
-        After real->complex conversion, the field array shape takes the form (Nx, Nr)
-        This final array is fed into _modeexpansion_naiv method.
+        The real and imaginary parts, each of shape (Nx, Nr), are passed as views
+        into this array to the _modeexpansion_naiv method. No copy is made.
         '''
-        array_list = []
-        modes = self._listAMmodes()[-1]
-        for mode in modes:
-
+        modes = self._listAMmodes()[key]
+        (Nx, Nr2) = self._shape("{}_mode_{}".format(key, modes[0]))
+        # raw data of all modes as dumped with shape (Nmodes, Nx, 2x Nr)
+        rawdata = np.empty((len(modes), Nx, Nr2), dtype=np.float64)
+        unitSI = np.empty(len(modes), dtype=np.float64)
+        # The modes are read sequentially on purpose: h5py serializes all calls to the
+        # hdf5 library with a global lock, so reading the modes from a thread pool
+        # does not overlap any I/O (tested with uncompressed and gzip compressed dumps).
+        for i, mode in enumerate(modes):
             field_name = key+"_mode_"+str(mode)
-            field_array = np.array(self._data[field_name])
-            field_array_shape = field_array.shape
-            reshaped_array = field_array.reshape(field_array_shape[0], field_array_shape[1]//2, 2)
-            complex_array = reshaped_array[:, :, 0] + 1j * reshaped_array[:, :, 1]
-            array_list.append(complex_array)
+            record = self._data[field_name]
+            record.read_direct(rawdata[i])
+            unitSI[i] = record.attrs['unitSI']
 
-        # Modified array of shape (Nmodes, Nx, Nr)
-        mod_complex_data = np.stack(array_list, axis=0)
-        factor = self._data["{}_mode_0".format(key)].attrs['unitSI']
-        return SmileiReader._modeexpansion_naiv(rawdata=mod_complex_data, theta=theta)*factor
+        real = rawdata[:, :, 0::2]
+        imag = rawdata[:, :, 1::2]
+        return SmileiReader._modeexpansion_naiv(real, imag, theta=theta, unitSI=unitSI,
+                                                modes=modes)
 
     def data(self, key, **kwargs):
         '''
@@ -243,18 +372,10 @@ class SmileiReader(OpenPMDreader):
         '''
 
         # checking whether the key is in AM mode dump
-        if key in self._listAMmodes()[0]:
+        if self._isAMkey(key):
             return self._getExpanded(key=key, **kwargs)
         else:
-            record = self._data[key]
-
-        if "value" in record.attrs:
-            # constant data (a single int or float)
-            ret = np.float64(record.attrs['value']) * record.attrs['unitSI']
-        else:
-            # array data
-            ret = np.float64(record[()]) * record.attrs['unitSI']
-        return ret
+            return super(SmileiReader, self).data(key)
 
     # To get the offsets of the grid.
     def gridoffset(self, key, axis):
@@ -262,7 +383,7 @@ class SmileiReader(OpenPMDreader):
 
         if axid == 91:  # theta
             return 0
-        elif key in self._listAMmodes()[0] and axid in [0, 90]:
+        elif self._isAMkey(key) and axid in [0, 90]:
             key = "{}_mode_0".format(key)
             axid = int(axid/90)
             return super(SmileiReader, self).gridoffset(key=key, axis=axid)
@@ -273,7 +394,7 @@ class SmileiReader(OpenPMDreader):
     def gridspacing(self, key, axis):
         axid = helper.axesidentify[axis]
 
-        if key in self._listAMmodes()[0] and axid in [0, 90]:
+        if self._isAMkey(key) and axid in [0, 90]:
             key = "{}_mode_0".format(key)
             axid = int(axid/90)
             return super(SmileiReader, self).gridspacing(key=key, axis=axid)
@@ -284,10 +405,10 @@ class SmileiReader(OpenPMDreader):
     def gridpoints(self, key, axis):
         axid = helper.axesidentify[axis]
 
-        if key in self._listAMmodes()[0]:
+        if self._isAMkey(key):
             key = "{}_mode_0".format(key)
-            (Nx, Nr) = self._data[key].shape
-            Nr = Nr/2
+            (Nx, Nr) = self._shape(key)
+            Nr = Nr // 2
             axid = int(axid/90)
             return (Nx, Nr)[axid]
         else:
@@ -367,30 +488,40 @@ class SmileiSeries(Simulationreader_ifc):
     Alternatively point this to a single file and you will only get
     the iterations which are present in that file:
     `simreader = SmileiSeries('path/to/simulation/Fields0.h5')`
+
+    The h5 file (or index file) is opened only once and shared by all readers
+    created by this series. The kwargs `rdcc_nbytes` and `rdcc_nslots` configure
+    its chunk cache, see `SmileiReader`. A `dumpreadercls` derived from
+    `SmileiReader` is called as `dumpreadercls(h5file, iteration, h5=h5)`,
+    any other as `dumpreadercls(h5file, iteration)` and opens the file itself.
     '''
 
-    def __init__(self, h5file, dumpreadercls=SmileiReader, **kwargs):
+    def __init__(self, h5file, dumpreadercls=SmileiReader,
+                 rdcc_nbytes=64 * 1024**2, rdcc_nslots=6151, **kwargs):
         super(SmileiSeries, self).__init__(h5file, **kwargs)
         self.dumpreadercls = dumpreadercls
         self.h5file = h5file
         self.path = os.path.basename(h5file)
         if os.path.isfile(h5file):
-            with h5py.File(h5file, 'r') as h5:
-                self._dumpkeys = list(h5['data'].keys())
+            h5name = h5file
         elif os.path.isdir(h5file):
-            indexfile = _getindexfile(h5file)
-            self._h5 = h5py.File(indexfile, 'r')
-            with h5py.File(indexfile, 'r') as h5:
-                self._dumpkeys = [int(i) for i in h5['data'].keys()]
+            h5name = _getindexfile(h5file)
         else:
             raise IOError('{} does not exist.'.format(h5file))
+        self._h5 = h5py.File(h5name, 'r', rdcc_nbytes=rdcc_nbytes,
+                             rdcc_nslots=rdcc_nslots, rdcc_w0=0.75)
+        # list and parse the iterations only once for the whole series
+        self._dumpkeys = [int(i) for i in self._h5['data']]
 
     def _getDumpreader(self, n):
         '''
         Do not use this method. It will be called by __getitem__.
         Use __getitem__ instead.
         '''
-        return self.dumpreadercls(self.h5file, self._dumpkeys[n])
+        iteration = self._dumpkeys[n]
+        if issubclass(self.dumpreadercls, SmileiReader):
+            return self.dumpreadercls(self.h5file, iteration, h5=self._h5)
+        return self.dumpreadercls(self.h5file, iteration)
 
     def __len__(self):
         return len(self._dumpkeys)
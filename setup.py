@@ -46,6 +46,7 @@ setup(name='postpic',
                         'packaging'],
       extras_require = {
         'h5 reader for openPMD support':  ['h5py'],
+        'numba to speed up the mode expansion of the Smilei reader': ['numba'],
         'sdf support for EPOCH reader':  ['sdf'],
         'PyPNG read png files': ['pypng'],
         'Pillow to read other image files': ['pillow'],
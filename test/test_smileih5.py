@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy as np
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+try:
+    import h5py
+    from postpic.datareader import smileih5
+    from postpic.datareader.smileih5 import SmileiReader, SmileiSeries
+except ImportError:
+    h5py = None
+
+
+def makesmileifile(fname, iterations=(100, 200), unitSI=(2.0, 2.0), Nx=6, Nr=4):
+    '''
+    Writes a small h5 file in the Smilei AM layout: the field `El` with one mode
+    per entry in unitSI, the cartesian field `Rho`, the scalar dataset `scalar`
+    and the integer dataset `ids`.
+    Returns the raw data of `El` with shape (Nmodes, Nx, 2 Nr) at every iteration.
+    '''
+    rng = np.random.RandomState(0)
+    ret = {}
+    with h5py.File(fname, 'w') as h5:
+        for iteration in iterations:
+            data = h5.create_group('data/{:010d}'.format(iteration))
+            data.attrs['time'] = float(iteration)
+            data.attrs['timeUnitSI'] = 1e-15
+            ret[iteration] = rng.normal(size=(len(unitSI), Nx, 2 * Nr))
+            for mode, unit in enumerate(unitSI):
+                ds = data.create_dataset('El_mode_{}'.format(mode), data=ret[iteration][mode])
+                ds.attrs['unitSI'] = unit
+            ds = data.create_dataset('Rho', data=np.full((Nx, Nr), float(iteration)))
+            ds.attrs['unitSI'] = 3.0
+            ds = data.create_dataset('scalar', data=1.5)
+            ds.attrs['unitSI'] = 2.0
+            ds = data.create_dataset('ids', data=np.arange(5, dtype=np.uint64))
+            ds.attrs['unitSI'] = 1.0
+    return ret
+
+
+@unittest.skipIf(h5py is None, 'h5py not available')
+class TestSmileiModeexpansion(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # interleaved (real, imag) as dumped by Smilei, shape (Nm, Nx, 2 Nr)
+        self.raw = rng.normal(size=(3, 6, 8))
+        # strided views, as passed by `SmileiReader._getExpanded`
+        self.real = self.raw[..., 0::2]
+        self.imag = self.raw[..., 1::2]
+
+    def reference(self, theta, unitSI=(1, 1, 1), modes=(0, 1, 2)):
+        F = np.zeros(self.real.shape[1:])
+        for i, m in enumerate(modes):
+            F += unitSI[i] * (self.real[i] * np.cos(m * theta)
+                              + self.imag[i] * np.sin(m * theta))
+        return F
+
+    def modeexpansions(self, **kwargs):
+        '''
+        Returns the mode expansion using the numba kernel (if numba is available)
+        and using the np.einsum fallback.
+        '''
+        ret = [SmileiReader._modeexpansion_naiv(self.real, self.imag, **kwargs)]
+        with mock.patch.object(smileih5, '_modeexp_kernel', None):
+            ret.append(SmileiReader._modeexpansion_naiv(self.real, self.imag, **kwargs))
+        return ret
+
+    def test_single_theta(self):
+        for data in self.modeexpansions(theta=0.3):
+            self.assertEqual(data.shape, (1, 6, 4))
+            self.assertTrue(np.allclose(data[0], self.reference(0.3)))
+
+    def test_multiple_theta(self):
+        theta = [0, 1.0, np.pi]
+        for data in self.modeexpansions(theta=theta):
+            self.assertEqual(data.shape, (3, 6, 4))
+            for i, t in enumerate(theta):
+                self.assertTrue(np.allclose(data[i], self.reference(t)))
+
+    def test_unitSI(self):
+        unitSI = np.array([1.0, 2.0, 3.0])
+        for data in self.modeexpansions(theta=0.3, unitSI=unitSI):
+            self.assertTrue(np.allclose(data[0], self.reference(0.3, unitSI=unitSI)))
+
+    def test_modes(self):
+        # mode numbers do not need to be contiguous
+        modes = [0, 2, 3]
+        for data in self.modeexpansions(theta=0.3, modes=modes):
+            self.assertTrue(np.allclose(data[0], self.reference(0.3, modes=modes)))
+
+
+@unittest.skipIf(h5py is None, 'h5py not available')
+class TestSmileiReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.h5file = os.path.join(self.tempdir, 'Fields0.h5')
+        makesmileifile(self.h5file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_iteration(self):
+        self.assertEqual(SmileiReader(self.h5file).timestep(), 100)
+        self.assertEqual(SmileiReader(self.h5file, 200).timestep(), 200)
+        self.assertRaises(IOError, SmileiReader, self.h5file, 300)
+        self.assertEqual(SmileiReader(self.h5file, 200.0).timestep(), 200)
+        self.assertRaises(IOError, SmileiReader, self.h5file, 100.9)
+        self.assertRaises(IOError, SmileiReader, self.h5file, 'abc')
+
+    def test_data(self):
+        dr = SmileiReader(self.h5file)
+        scalar = dr.data('scalar')
+        self.assertIsInstance(scalar, np.float64)
+        self.assertEqual(scalar, 3.0)
+        ids = dr.data('ids')
+        self.assertEqual(ids.dtype, np.float64)
+        self.assertTrue(np.all(ids == np.arange(5)))
+        rho = dr.data('Rho')
+        self.assertEqual(rho.shape, (6, 4))
+        self.assertTrue(np.all(rho == 3.0 * 100))
+
+    def test_series_file(self):
+        sr = SmileiSeries(self.h5file)
+        self.assertEqual(len(sr), 2)
+        self.assertEqual([dr.timestep() for dr in sr], [100, 200])
+
+    def test_series_dir(self):
+        sr = SmileiSeries(self.tempdir)
+        self.assertEqual(len(sr), 2)
+        self.assertEqual([dr.timestep() for dr in sr], [100, 200])
+        self.assertEqual(SmileiReader(self.tempdir).timestep(), 100)
+        self.assertRaises(IOError, SmileiReader, self.tempdir, 300)
+
+    def test_data_modeexpansion(self):
+        h5file = os.path.join(self.tempdir, 'Fields1.h5')
+        unitSI = (2.0, 4.0, 0.5)
+        raw = makesmileifile(h5file, iterations=(100,), unitSI=unitSI)[100]
+        theta = [0, 0.3, np.pi]
+        data = SmileiReader(h5file).data('El', theta=theta)
+        self.assertEqual(data.shape, (3, 6, 4))
+        for i, t in enumerate(theta):
+            F = np.zeros((6, 4))
+            for m in range(3):
+                F += unitSI[m] * (raw[m, :, 0::2] * np.cos(m * t)
+                                  + raw[m, :, 1::2] * np.sin(m * t))
+            self.assertTrue(np.allclose(data[i], F))
+
+    def test_series_shared_file(self):
+        sr = SmileiSeries(self.h5file)
+        dr0, dr1 = sr[0], sr[1]
+        self.assertIs(dr0._h5, dr1._h5)
+        self.assertTrue(np.all(dr0.data('Rho') == 3.0 * 100))
+        self.assertTrue(np.all(dr1.data('Rho') == 3.0 * 200))
+
+    def test_series_subclass(self):
+        # the __init__ of SmileiReader subclasses must run
+        class Reader(SmileiReader):
+            def __init__(self, *args, **kwargs):
+                super(Reader, self).__init__(*args, **kwargs)
+                self.extra = True
+
+        sr = SmileiSeries(self.h5file, dumpreadercls=Reader)
+        dr0, dr1 = sr[0], sr[1]
+        self.assertTrue(dr0.extra)
+        self.assertIs(dr0._h5, dr1._h5)
+        self.assertTrue(np.all(dr1.data('Rho') == 3.0 * 200))
+
+    def test_series_dumpreadercls(self):
+        # other classes are called with (h5file, iteration)
+        class Reader(object):
+            def __init__(self, h5file, iteration):
+                self.args = (h5file, iteration)
+
+        sr = SmileiSeries(self.h5file, dumpreadercls=Reader)
+        self.assertEqual(sr[1].args, (self.h5file, 200))
+
+
+@unittest.skipIf(h5py is None, 'h5py not available')
+class TestSmileiIndexfile(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        makesmileifile(os.path.join(self.tempdir, 'Fields0.h5'))
+        makesmileifile(os.path.join(self.tempdir, 'Fields1.h5'), iterations=(300,))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_indexfile_after_modeexpansion(self):
+        # generating the index file after the mode expansion (possibly starting the
+        # numba thread pool) must not keep the interpreter from exiting.
+        script = '\n'.join([
+            'import sys',
+            'from postpic.datareader.smileih5 import SmileiReader',
+            'SmileiReader(sys.argv[1] + "/Fields0.h5").data("El")',
+            'print(SmileiReader(sys.argv[1], 300).data("Rho")[0, 0])'])
+        out = subprocess.check_output([sys.executable, '-c', script, self.tempdir],
+                                      timeout=60)
+        self.assertEqual(out.split()[-1], b'900.0')
+
+
+if __name__ == '__main__':
+    unittest.main()